@@ -4,21 +4,44 @@
 import configparser
 import hashlib
 import json
+import math
 import os
 import sys
+import threading
+import time
 import traceback
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import NoSectionError, NoOptionError
 from datetime import datetime
 from getpass import getpass
-from multiprocessing.pool import ThreadPool
 from textwrap import dedent
 from typing import Any, Iterator, Optional, TextIO, Union
 from urllib import parse
 
 import gpsoauth
 import requests
-from requests.exceptions import HTTPError, ConnectionError, Timeout, RequestException
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    ChunkedEncodingError, HTTPError, ConnectionError, Timeout, RequestException
+)
+from urllib3.util import Retry
+
+try:
+    # orjson parses JSON several times faster than the stdlib, which adds up
+    # over thousands of listing pages, but it's optional
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+# The size of each chunk when downloading files. Without an explicit size,
+# raw streams can be read in tiny pieces, which is very slow
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+
+# A download stream that delivers nothing for this many seconds is considered
+# stalled, and how many times we restart a stalled stream before giving up
+STALL_TIMEOUT = 60
+MAX_RESUMES = 4
 
 
 def human_datetime(iso_datetime: str) -> str:
@@ -26,16 +49,23 @@ def human_datetime(iso_datetime: str) -> str:
     return datetime.fromisoformat(iso_datetime.replace('Z', '')).strftime('%H:%M on %d %b %Y')
 
 
+_UNITS = ['B', 'kiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB']
+
+
 def human_size(size: Union[int, float]) -> str:
     """Return the human-readable size of a number of bytes."""
-    for s in ['B', 'kiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB']:
-        if abs(size) < 1024:
-            return f'{size:.2f} {s}'
+    if size == 0:
+        return '0.00 B'
 
-        size /= 1024
+    # Pick the unit straight from the bit length instead of dividing in a loop
+    i = min(len(_UNITS) - 1, max(0, int(math.log2(abs(size))) // 10))
+    return f'{size / (1 << (10 * i)):.2f} {_UNITS[i]}'
 
-    # If we didn't hit a good size, then just go with the max
-    return f'{size:.2f} YiB'
+
+def _rel_name(name: str) -> str:
+    """Return the local path of a backup file, stripping the "clients/wa/backups" prefix."""
+    # A single bounded split avoids allocating a list of every path segment
+    return name.split('/', 3)[3].replace('/', os.sep)
 
 
 def have_file(file: str, size: int, md5: bytes) -> bool:
@@ -43,34 +73,135 @@ def have_file(file: str, size: int, md5: bytes) -> bool:
     if not os.path.exists(file) or size != os.path.getsize(file):
         return False
 
-    digest = hashlib.md5()
-
     with open(file, 'br') as inp:
+        # Tell the kernel we're reading front to back so it readaheads aggressively
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(inp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        # file_digest hashes inside OpenSSL with the GIL released, so several
+        # pool workers can hash at once, but it only exists on Python 3.11+
+        if hasattr(hashlib, 'file_digest'):
+            return md5 == hashlib.file_digest(inp, 'md5').digest()
+
+        digest = hashlib.md5()
+
         while True:
-            b = inp.read(8 * 1024)
+            b = inp.read(1024 * 1024)
 
             if not b:
                 break
 
             digest.update(b)
 
-    return md5 == digest.digest()
+        return md5 == digest.digest()
 
 
-def download_file(file: str, stream: requests.Response) -> None:
-    """Download a file from the given stream."""
+def download_file(
+    file: str,
+    stream: requests.Response,
+    size: int = 0,
+    offset: int = 0,
+    digest: Optional[Any] = None
+) -> int:
+    """Write a download stream to the named file from the given offset, and return the bytes written so far.
+
+    If the final size is known, the file is preallocated up front to avoid
+    growing it one chunk at a time. If a hashlib digest is given, it's updated
+    with every chunk as it's written.
+    """
     os.makedirs(os.path.dirname(file), exist_ok=True)
 
-    with open(file, 'bw') as dest:
-        for chunk in stream.iter_content(chunk_size=None):
-            dest.write(chunk)
+    written = offset
+
+    # Write chunks straight to a raw fd. The chunks are already large, so
+    # Python's buffered writer would only add an extra copy per chunk
+    flags = os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC) | getattr(os, 'O_BINARY', 0)
+    fd = os.open(file, flags, 0o644)
+
+    try:
+        if size and not offset:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+
+        if offset:
+            os.lseek(fd, offset, os.SEEK_SET)
+
+        try:
+            for chunk in stream.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if digest is not None:
+                    digest.update(chunk)
+
+                os.write(fd, chunk)
+                written += len(chunk)
+
+        except (ConnectionError, Timeout, ChunkedEncodingError):
+            # Drop any preallocated tail so the file's size reflects the
+            # bytes actually written, which is where a resume restarts
+            os.ftruncate(fd, written)
+            raise
+
+        # Downloads are write-once, so don't let them evict more useful page cache
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    finally:
+        os.close(fd)
+
+    return written
+
+
+class AimdSemaphore:
+    """Limit concurrency adaptively, like TCP congestion control.
+
+    The permit count grows by one after each successful download and is halved
+    whenever the server rate-limits or times out, so concurrency settles near
+    whatever the API will actually tolerate.
+    """
+
+    def __init__(self, initial: int = 4, maximum: int = 32):
+        """Start with the given number of permits, never growing past the maximum."""
+        self._cond = threading.Condition()
+        self._limit = initial
+        self._maximum = maximum
+        self._in_flight = 0
+
+    def acquire(self) -> None:
+        """Block until a permit is available, then take it."""
+        with self._cond:
+            while self._in_flight >= self._limit:
+                self._cond.wait()
+
+            self._in_flight += 1
+
+    def release_success(self) -> None:
+        """Return a permit and additively raise the concurrency limit."""
+        with self._cond:
+            self._in_flight -= 1
+
+            if self._limit < self._maximum:
+                self._limit += 1
+
+            self._cond.notify_all()
+
+    def release_failure(self) -> None:
+        """Return a permit and halve the concurrency limit."""
+        with self._cond:
+            self._in_flight -= 1
+            self._limit = max(1, self._limit // 2)
+            self._cond.notify_all()
 
 
 class WaBackup:
     """Provide access to WhatsApp backups stored in Google drive."""
 
-    def __init__(self, gmail: str, password: str, android_id: str):
+    __slots__ = ('auth', 'session', 'pool_size', '_cache')
+
+    def __init__(self, gmail: str, password: str, android_id: str, pool_size: int = 32):
         """Authorise this script with the given details."""
+        self.pool_size = pool_size
+        self._cache: dict[str, bytes] = {}
         token = gpsoauth.perform_master_login(gmail, password, android_id)
 
         if 'Token' not in token:
@@ -85,16 +216,55 @@ class WaBackup:
             '38a0f7d505fe18fec64fbf343ecaaaf310dbd799'
         )
 
+        # Keep one session so that HTTP keep-alive reuses TCP/TLS connections
+        # instead of doing a fresh handshake for every request
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {self.auth["Auth"]}'
+
+        # Retry rate limits and transient server errors with exponential
+        # backoff, honouring any Retry-After header that Google sends
+        retries = Retry(
+            total=8,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True
+        )
+
+        # Match the connection pool to the download pool so that concurrent
+        # downloads aren't serialized behind too few connections
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self) -> None:
+        """Close the underlying HTTP session."""
+        self.session.close()
+
+    def read_checksum_cache(self, path: str) -> None:
+        """Remember the checksums written by a previous sync, so unchanged files can skip hashing."""
+        try:
+            with open(path, encoding='utf-8') as cksums:
+                for line in cksums:
+                    md5_hex, _, name = line.rstrip('\n').partition(' *')
+
+                    if name:
+                        self._cache[name] = bytes.fromhex(md5_hex)
+
+        except (OSError, ValueError):
+            self._cache.clear()
+
     def get(self, path: str, params: Optional[dict[str, str]] = None, **kwargs) -> requests.Response:
-        """Perform a get request to the given path in the Google APIs, and return the response object."""
-        path = parse.quote(path)
+        """Perform a get request to the given path in the Google APIs, and return the response object.
 
-        response = requests.Response()
+        The session's adapter already retries transient failures, so once an
+        error reaches here it's final and is raised to the caller, rather than
+        returning a broken response for them to choke on.
+        """
+        path = parse.quote(path, safe='/:')
 
         try:
-            response = requests.get(
+            response = self.session.get(
                 f'https://backup.googleapis.com/v1/{path}',
-                headers={'Authorization': f'Bearer {self.auth["Auth"]}'},
                 params=params,
                 **kwargs
             )
@@ -102,21 +272,25 @@ class WaBackup:
 
         except HTTPError as err_http:
             print('\n\nHTTP Error:', err_http)
+            raise
 
         except ConnectionError as err_conn:
             print('\n\nError Connecting:', err_conn)
+            raise
 
         except Timeout as err_timeout:
             print('\n\nTimeout Error:', err_timeout)
+            raise
 
         except RequestException as err_req:
             print('\n\nOops: Something Else', err_req)
+            raise
 
         return response
 
     def get_page(self, path: str, page_token: Optional[str] = None) -> Any:
         """Return the JSON of a get request to the given path and optional page token."""
-        return self.get(path, None if page_token is None else {'pageToken': page_token}).json()
+        return _json_loads(self.get(path, None if page_token is None else {'pageToken': page_token}).content)
 
     def list_path(self, path: str) -> Iterator[Any]:
         """Iterate through every item in every page in the given path. This is a generator."""
@@ -142,40 +316,139 @@ class WaBackup:
         """Iterate through every file in the given backup. This is a generator."""
         return self.list_path(f'{backup["name"]}/files')
 
+    def download(self, name: str, path: str, size: int = 0, md5: Optional[bytes] = None) -> None:
+        """Stream the file at the given API path into the named local file.
+
+        If the stream delivers nothing for STALL_TIMEOUT seconds, restart it
+        with a ranged request from the bytes already written, so one slow edge
+        server can't wedge a download slot forever.
+
+        If an expected MD5 hash is given, the stream is hashed as it's written,
+        so the file never has to be re-read to verify it. A mismatch deletes
+        the file and raises ValueError.
+        """
+        written = 0
+
+        for attempt in range(MAX_RESUMES + 1):
+            digest = hashlib.md5() if md5 is not None else None
+
+            # A resumed stream only delivers the tail, so hash the part already on disk
+            if digest is not None and written:
+                with open(name, 'br') as inp:
+                    while True:
+                        b = inp.read(DOWNLOAD_CHUNK_SIZE)
+
+                        if not b:
+                            break
+
+                        digest.update(b)
+
+            headers = {'Range': f'bytes={written}-'} if written else None
+            stream = self.get(path, {'alt': 'media'}, stream=True, timeout=STALL_TIMEOUT, headers=headers)
+
+            try:
+                download_file(name, stream, size, written, digest)
+
+            except (ConnectionError, Timeout, ChunkedEncodingError):
+                if attempt == MAX_RESUMES:
+                    raise
+
+                written = os.path.getsize(name) if os.path.exists(name) else 0
+                continue
+
+            if digest is not None and digest.digest() != md5:
+                # Throw the corrupt file away and re-fetch it from scratch
+                # while there's still retry budget
+                os.unlink(name)
+
+                if attempt == MAX_RESUMES:
+                    raise ValueError(f'MD5 mismatch in downloaded file "{name}"')
+
+                written = 0
+                continue
+
+            return
+
     def fetch(self, file: dict[str, str]) -> tuple[str, int, bytes]:
         """Download the file, and then return the name, size, and hash of the given file dictionary."""
-        name = os.path.join(*file['name'].split("/")[3:])
+        name = _rel_name(file['name'])
+        size = int(file['sizeBytes'])
         md5_hash = b64decode(file['md5Hash'], validate=True)
 
-        if not have_file(name, int(file['sizeBytes']), md5_hash):
-            download_file(name, self.get(file['name'], {'alt': 'media'}, stream=True))
+        # If the previous sync confirmed this file's hash and the size still
+        # matches, we can skip re-reading the whole file
+        cached = (
+            self._cache.get(name) == md5_hash
+            and os.path.exists(name)
+            and os.path.getsize(name) == size
+        )
+
+        if not cached and not have_file(name, size, md5_hash):
+            self.download(name, file['name'], size, md5_hash)
 
-        return name, int(file['sizeBytes']), md5_hash
+        self._cache[name] = md5_hash
+        return name, size, md5_hash
 
-    def fetch_all(self, backup: dict[str, str], cksums: TextIO) -> None:
+    def fetch_all(self, backup: dict[str, str], cksums: TextIO, pool_size: Optional[int] = None) -> None:
         """Fetch every file in the backup, and write their checksums to the cksums file object."""
+        if pool_size is None:
+            pool_size = self.pool_size
+
         num_files = 0
         total_size = 0
+        semaphore = AimdSemaphore(initial=4, maximum=pool_size)
+
+        def fetch_limited(file: dict[str, str]) -> tuple[str, int, bytes]:
+            semaphore.acquire()
+            success = False
+
+            # Release in a finally so no exception can leak a permit and
+            # wedge every other worker in acquire()
+            try:
+                result = self.fetch(file)
+                success = True
+                return result
 
-        with ThreadPool(10) as pool:
-            downloads = pool.imap_unordered(self.fetch, self.backup_files(backup))
+            finally:
+                if success:
+                    semaphore.release_success()
+                else:
+                    semaphore.release_failure()
 
-            for name, size, md5_hash in downloads:
+        last_print = 0.0
+
+        with ThreadPoolExecutor(max_workers=pool_size) as pool:
+            downloads = [pool.submit(fetch_limited, file) for file in self.backup_files(backup)]
+
+            for future in as_completed(downloads):
+                name, size, md5_hash = future.result()
                 num_files += 1
                 total_size += size
 
-                # The \r here is to move the cursor to the start of the line every time
-                print(
-                    f'\rProgress: {100 * total_size / int(backup["sizeBytes"]):7.3f}% '
-                    f'{os.path.basename(name)[-60:]:60}', end='', flush=True
-                )
+                # Redraw the progress line at most ~10 times a second, so
+                # thousands of fast files don't mean thousands of tty writes
+                now = time.monotonic()
+
+                if now - last_print > 0.1 or num_files == len(downloads):
+                    last_print = now
+
+                    # The \r here is to move the cursor to the start of the line every time
+                    sys.stdout.write(
+                        f'\rProgress: {100 * total_size / int(backup["sizeBytes"]):7.3f}% '
+                        f'{os.path.basename(name)[-60:]:60}'
+                    )
+                    sys.stdout.flush()
 
                 cksums.write(f'{md5_hash.hex()} *{name}\n')
 
+                # Flush every so often so a crash doesn't lose every checksum
+                if num_files % 100 == 0:
+                    cksums.flush()
+
         print(f'\n\n{num_files} files ({human_size(total_size)})')
 
 
-def get_configs() -> dict[str, str]:
+def get_configs() -> dict[str, Any]:
     """Read from the config file and return a dictionary of its values."""
     config = configparser.ConfigParser()
 
@@ -185,6 +458,7 @@ def get_configs() -> dict[str, str]:
         android_id = config.get('auth', 'android_id')
         gmail = config.get('auth', 'gmail')
         password = config.get('auth', 'password', fallback='')
+        pool_size = config.getint('sync', 'pool_size', fallback=32)
 
         if not password:
             try:
@@ -197,7 +471,8 @@ def get_configs() -> dict[str, str]:
         return {
             'android_id': android_id,
             'gmail': gmail,
-            'password': password
+            'password': password,
+            'pool_size': pool_size
         }
 
     except (NoSectionError, NoOptionError):
@@ -216,12 +491,16 @@ def create_settings_file() -> None:
             password = yourpassword
             # The result of "adb shell settings get secure android_id".
             android_id = 0000000000000000
+
+            [sync]
+            # Optional. The number of files to download concurrently.
+            pool_size = 32
             '''))
 
 
 def backup_info(backup: dict[str, str]) -> None:
     """Print the info of the given backup."""
-    metadata = json.loads(backup['metadata'])
+    metadata = _json_loads(backup['metadata'])
 
     for size in 'backupSize', 'chatdbSize', 'mediaSize', 'videoSize':
         metadata[size] = human_size(int(metadata[size]))
@@ -283,13 +562,13 @@ def main(args: list[str]) -> None:
                 try:
                     num_files += 1
                     total_size += int(file['sizeBytes'])
-                    print(os.path.join(*file['name'].split("/")[3:]))
+                    print(_rel_name(file['name']))
 
                 except (KeyError, ValueError):
                     print(dedent(f'''
                     #####
 
-                    Warning: Unexpected error in file "{os.path.join(file["name"].split("/")[3:])}"
+                    Warning: Unexpected error in file "{_rel_name(file["name"])}"
 
                     Detail: {json.dumps(file, indent=4, sort_keys=True)}
 
@@ -303,7 +582,9 @@ def main(args: list[str]) -> None:
             print(f'\n{num_files} files ({human_size(total_size)})\n')
 
     elif args[1] == 'sync':
-        with open('md5sum.txt', 'w', encoding='utf-8', buffering=1) as cksums:
+        wa_backup.read_checksum_cache('md5sum.txt')
+
+        with open('md5sum.txt', 'w', encoding='utf-8') as cksums:
             for backup in backups:
                 try:
                     answer = input(f'\nDo you want {os.path.split(backup["name"])[-1]}? (y/N): ')
@@ -318,7 +599,7 @@ def main(args: list[str]) -> None:
 
                     print()
 
-                except (KeyError, ValueError):
+                except (KeyError, ValueError, RequestException):
                     print(dedent(f'''
                     #####
 
@@ -331,6 +612,8 @@ def main(args: list[str]) -> None:
                     '''))
                     input("Press the <Enter> key to continue...")
 
+    wa_backup.close()
+
 
 if __name__ == '__main__':
     main(sys.argv)